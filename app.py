@@ -1,102 +1,313 @@
+import asyncio
+import contextlib
 import io
+import multiprocessing
+import os
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 from datetime import datetime
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from functools import lru_cache
+from typing import BinaryIO, Iterator
+from urllib.parse import quote
+from zoneinfo import ZoneInfo
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Response
 from fastapi.responses import StreamingResponse
-from pypdf import PdfReader, PdfWriter
+import pikepdf
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.units import inch
-import pytz # Necessário para o fuso horário
+
+def _new_pool() -> ProcessPoolExecutor:
+    # PDF_POOL_WORKERS: tamanho do pool; padrão = número de CPUs
+    max_workers = int(os.environ.get("PDF_POOL_WORKERS", 0)) or os.cpu_count()
+    # forkserver: não fazer fork do servidor já rodando (event loop e threads do anyio),
+    # o que pode travar em locks herdados; cada worker importa o módulo e monta os overlays
+    return ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("forkserver")
+    )
+
+def _replace_broken_pool(broken: ProcessPoolExecutor) -> None:
+    """
+    Troca um pool quebrado (um worker morreu: OOM, segfault do qpdf...) por um novo.
+    Só troca se app.state.pool ainda for o pool quebrado, então várias requisições
+    que falharam juntas não criam vários pools (não há await entre o teste e a troca).
+    """
+    if app.state.pool is broken:
+        app.state.pool = _new_pool()
+        broken.shutdown(wait=False)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Pool de processos para o trabalho de CPU (ReportLab/pikepdf), para não
+    # bloquear o event loop enquanto um PDF está sendo processado
+    app.state.pool = _new_pool()
+    yield
+    app.state.pool.shutdown(wait=False)
 
 app = FastAPI(
     title="PDF Text Overlay API",
-    description="API para adicionar texto na capa."
+    description="API para adicionar texto na capa.",
+    lifespan=lifespan,
 )
 
-# --- Lógica de Adicionar Texto (Endpoint /process-pdf/) ---
+# --- Overlay Estático (gerado uma única vez, na importação do módulo) ---
+
+# Coordenadas de cada linha (começando do topo)
+X_MARGIN = inch
+# --- ALTERAÇÃO DE POSIÇÃO AQUI ---
+Y_TITULO = letter[1] - 0.25 * inch # Começa 0.5 polegada do topo (mais para cima)
+# ----------------------------------
+Y_SUBTITULO = Y_TITULO - 0.25 * inch
+Y_MAPA = Y_SUBTITULO - 0.25 * inch
+Y_NOME = Y_MAPA - 0.4 * inch # Espaço
+Y_TELEFONE = Y_NOME - 0.2 * inch
+Y_DATA = Y_TELEFONE - 0.2 * inch
+Y_TIPO = Y_DATA - 0.2 * inch
+Y_CONFIDENCIAL = Y_TIPO - 0.4 * inch # Espaço
 
-def add_text_to_pdf_logic(pdf_bytes: bytes, nome: str, telefone: str) -> bytes:
+def _build_static_overlay() -> bytes:
     """
-    Lógica central para adicionar texto formatado ao PDF como overlay.
+    Gera com ReportLab a parte fixa do cabeçalho (tudo exceto Nome, Telefone e Data).
     """
-    
-    # 1. Criar um PDF temporário (overlay) com o texto usando ReportLab
     packet = io.BytesIO()
     can = canvas.Canvas(packet, pagesize=letter)
     
-    # Coordenadas iniciais (começando do topo)
-    x_margin = inch
-    # --- ALTERAÇÃO DE POSIÇÃO AQUI ---
-    y_position = letter[1] - 0.25 * inch # Começa 0.5 polegada do topo (mais para cima)
-    # ----------------------------------
-    
-    # Fuso Horário de São Paulo
-    fuso_sp = pytz.timezone('America/Sao_Paulo')
-    data_sp = datetime.now(fuso_sp)
-    data_atual = data_sp.strftime("%d/%m/%Y")
-    
-    # --- Conteúdo Formatado ---
-    
     # Título Principal (Negrito e Maior)
     can.setFont("Helvetica-Bold", 12)
-    can.drawString(x_margin, y_position, "🧬 Instituto Vitalis de Salud Femenina")
-    y_position -= 0.25 * inch
-    can.drawString(x_margin, y_position, "Diagnóstico Hormonal Personalizado")
-    y_position -= 0.25 * inch
-    can.drawString(x_margin, y_position, "Mapa de la Cascada Hormonal y Nivel de Estrés Endocrino")
-    
-    y_position -= 0.4 * inch # Espaço
+    can.drawString(X_MARGIN, Y_TITULO, "🧬 Instituto Vitalis de Salud Femenina")
+    can.drawString(X_MARGIN, Y_SUBTITULO, "Diagnóstico Hormonal Personalizado")
+    can.drawString(X_MARGIN, Y_MAPA, "Mapa de la Cascada Hormonal y Nivel de Estrés Endocrino")
     
-    # Informações Dinâmicas (Normal)
+    # Informações Fixas (Normal)
     can.setFont("Helvetica", 10)
-    can.drawString(x_margin, y_position, f"Nombre: {nome}")
-    y_position -= 0.2 * inch
-    can.drawString(x_margin, y_position, f"Telefono: {telefone}")
-    y_position -= 0.2 * inch
-    can.drawString(x_margin, y_position, f"Fecha: {data_atual}")
-    y_position -= 0.2 * inch
-    can.drawString(x_margin, y_position, "Tipo de Evaluación: Prediagnóstico de Cascada Hormonal")
-    
-    y_position -= 0.4 * inch # Espaço
+    can.drawString(X_MARGIN, Y_TIPO, "Tipo de Evaluación: Prediagnóstico de Cascada Hormonal")
     
     # Linha Confidencial (Itálico e Menor)
     can.setFont("Helvetica-Oblique", 9) # Helvetica-Oblique para itálico
-    can.drawString(x_margin, y_position, "Informe confidencial preparado con base en sus respuestas al cuestionario de equilibrio hormonal.")
+    can.drawString(X_MARGIN, Y_CONFIDENCIAL, "Informe confidencial preparado con base en sus respuestas al cuestionario de equilibrio hormonal.")
+    
+    can.save()
+    return packet.getvalue()
+
+def _build_dynamic_overlay() -> bytes:
+    """
+    Gera com ReportLab as linhas de Nome, Telefone e Data, com marcadores no lugar
+    dos valores. O PDF resultante serve de base para o overlay de cada requisição.
+    """
+    packet = io.BytesIO()
+    can = canvas.Canvas(packet, pagesize=letter)
     
-    # --- Fim do Overlay ---
+    # Informações Dinâmicas (Normal)
+    can.setFont("Helvetica", 10)
+    can.drawString(X_MARGIN, Y_NOME, "Nombre: @@NOME@@")
+    can.drawString(X_MARGIN, Y_TELEFONE, "Telefono: @@TELEFONE@@")
+    can.drawString(X_MARGIN, Y_DATA, "Fecha: @@DATA@@")
     
     can.save()
+    return packet.getvalue()
+
+def _rename_fonts(overlay_page: pikepdf.Page, prefixo: str) -> tuple[bytes, dict[str, pikepdf.Object]]:
+    """
+    Renomeia as fontes do overlay (/F1, /F2, ...) para /<prefixo>1, /<prefixo>2, ...,
+    para não colidir com as fontes da página de destino. Devolve o content stream
+    reescrito e o dicionário nome -> fonte.
+    """
+    fontes = overlay_page.Resources.Font
+    novos_nomes = {nome: pikepdf.Name(f"/{prefixo}{nome[2:]}") for nome in fontes.keys()}
     
-    # 2. Mesclar o Overlay com o PDF Original
+    instrucoes = []
+    for operandos, operador in pikepdf.parse_content_stream(overlay_page):
+        if operador == pikepdf.Operator("Tf"):
+            operandos = [novos_nomes[str(operandos[0])], *operandos[1:]]
+        instrucoes.append((operandos, operador))
+    
+    stream = pikepdf.unparse_content_stream(instrucoes)
+    return stream, {str(novos_nomes[nome]): fontes[nome] for nome in fontes.keys()}
+
+def _content_stream_template(stream: bytes) -> str:
+    """
+    Converte o content stream do overlay dinâmico em template para str.format,
+    com os campos {nome}, {telefone} e {data}.
+    """
+    # O overlay dinâmico só tem texto ASCII (os marcadores e os rótulos)
+    return (
+        stream.decode("ascii")
+        .replace("{", "{{").replace("}", "}}")
+        .replace("@@NOME@@", "{nome}")
+        .replace("@@TELEFONE@@", "{telefone}")
+        .replace("@@DATA@@", "{data}")
+    )
+
+def _pdf_escape(texto: str) -> str:
+    """
+    Escapa um texto para uso dentro de uma string literal (...) de um content stream.
+    """
+    # str.replace roda inteiro em C; é bem mais rápido que str.translate com dict
+    return texto.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+# Fuso Horário de São Paulo
+_TZ_SP = ZoneInfo('America/Sao_Paulo')
+
+_STATIC_OVERLAY = pikepdf.open(io.BytesIO(_build_static_overlay()))
+_STATIC_STREAM, _static_fonts = _rename_fonts(_STATIC_OVERLAY.pages[0], "VitalisE")
+
+_DYNAMIC_OVERLAY = pikepdf.open(io.BytesIO(_build_dynamic_overlay()))
+_dynamic_stream, _dynamic_fonts = _rename_fonts(_DYNAMIC_OVERLAY.pages[0], "VitalisD")
+_DYNAMIC_STREAM_TEMPLATE = _content_stream_template(_dynamic_stream)
+
+# Todas as fontes dos overlays num único dicionário indireto, copiado (copy_foreign)
+# para o PDF de cada requisição
+_OVERLAY_FONTS = _STATIC_OVERLAY.make_indirect(pikepdf.Dictionary({
+    **_static_fonts,
+    **{nome: _STATIC_OVERLAY.copy_foreign(fonte) for nome, fonte in _dynamic_fonts.items()},
+}))
+
+# --- Lógica de Adicionar Texto (Endpoint /process-pdf/) ---
+
+# Regra para montar conteúdo de PDF (content streams, etc.): acumular os pedaços em
+# um bytearray (buf += pedaco) e converter com bytes(buf) no fim. Nunca concatenar
+# str/bytes em loop (s += pedaco): com conteúdo por página isso vira O(N²).
+
+@lru_cache(maxsize=1024)
+def _overlay_content(nome: str, telefone: str, data_atual: str) -> bytes:
+    """
+    Content stream completo do overlay (parte estática + Nome, Telefone e Data).
+    O resultado é determinístico, então fica em cache (um cache por processo do pool),
+    o que torna reenvios do mesmo paciente no mesmo dia uma simples consulta.
+    """
+    stream = _DYNAMIC_STREAM_TEMPLATE.format(
+        nome=_pdf_escape(nome),
+        telefone=_pdf_escape(telefone),
+        data=data_atual,
+    )
+    
+    # O conteúdo original da capa fica isolado em q ... Q (ver add_text_to_pdf_logic)
+    # e cada parte do overlay também, para não herdarem estado gráfico umas das outras.
+    # Helvetica usa WinAnsiEncoding (cp1252); o que não couber vira "?"
+    overlay = bytearray(b"Q\nq\n")
+    overlay += _STATIC_STREAM
+    overlay += b"\nQ\nq\n"
+    overlay += stream.encode("cp1252", "replace")
+    overlay += b"\nQ\n"
+    return bytes(overlay)
+
+def _stamp_cover(existing_pdf: pikepdf.Pdf, nome: str, telefone: str) -> None:
+    """
+    Aplica o cabeçalho formatado na primeira página (capa) do PDF já aberto.
+    """
     
-    # Mover o ponteiro do BytesIO para o início para leitura
-    packet.seek(0)
-    new_pdf = PdfReader(packet)
+    # 1. Montar o content stream do overlay (em cache por nome/telefone/data)
+    data_atual = datetime.now(_TZ_SP).strftime("%d/%m/%Y")
+    overlay = _overlay_content(nome, telefone, data_atual)
     
-    # Ler o PDF original
-    existing_pdf = PdfReader(io.BytesIO(pdf_bytes))
-    output = PdfWriter()
+    # 2. Mesclar o Overlay com o PDF Original
     
     # Aplicar o overlay na primeira página (capa)
     if not existing_pdf.pages:
         raise ValueError("O PDF original não contém páginas.")
-        
-    page = existing_pdf.pages[0]
-    page.merge_page(new_pdf.pages[0])
-    output.add_page(page)
     
-    # Adicionar as páginas restantes
-    for i in range(1, len(existing_pdf.pages)):
-        output.add_page(existing_pdf.pages[i])
+    capa = existing_pdf.pages[0]
+    
+    # Registrar as fontes do overlay nos recursos da capa
+    for nome_fonte, fonte in existing_pdf.copy_foreign(_OVERLAY_FONTS).items():
+        capa.add_resource(fonte, pikepdf.Name.Font, pikepdf.Name(nome_fonte))
+    
+    # Anexar o overlay direto ao content stream da capa, sem Form XObject nem
+    # merge de recursos
+    capa.contents_add(b"q\n", prepend=True)
+    capa.contents_add(overlay)
+
+def add_text_to_pdf_logic(
+    pdf_bytes: bytes, nome: str, telefone: str, output_path: str | None = None
+) -> bytes | None:
+    """
+    Lógica central para adicionar texto formatado ao PDF como overlay.
+    Com output_path, grava o PDF modificado nesse arquivo e retorna None (usado para
+    PDFs grandes, que são devolvidos a partir do disco); sem ele, retorna os bytes.
+    """
+    
+    # Ler o PDF original (pikepdf/qpdf mantém a árvore de páginas original,
+    # sem copiar página por página em Python)
+    with pikepdf.open(io.BytesIO(pdf_bytes)) as existing_pdf:
+        _stamp_cover(existing_pdf, nome, telefone)
         
-    # Salvar o PDF modificado em um buffer de bytes
-    output_buffer = io.BytesIO()
-    output.write(output_buffer)
-    output_buffer.seek(0)
+        if output_path is not None:
+            existing_pdf.save(output_path, linearize=False)
+            return None
+        
+        # Salvar o PDF modificado em um buffer de bytes
+        output_buffer = io.BytesIO()
+        existing_pdf.save(output_buffer, linearize=False)
     
     # Retornar o PDF modificado como bytes
     return output_buffer.getvalue()
 
+UPLOAD_CHUNK_SIZE = 1 << 20 # 1 MiB
+PDF_HEADER = b"%PDF-"
+PDF_HEADER_SEARCH_LIMIT = 1024
+POOL_RESTARTED_DETAIL = "O processamento de PDF foi reiniciado após uma falha; tente novamente."
+DOWNLOAD_CHUNK_SIZE = 1 << 20 # 1 MiB
+LARGE_PDF_THRESHOLD = 10_000_000 # ~10 MB: acima disso a resposta sai de um arquivo temporário
+
+async def _read_upload(upload: UploadFile) -> bytearray:
+    """
+    Lê o arquivo enviado em blocos para um único bytearray, sem concatenar bytes.
+    """
+    buf = bytearray()
+    while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+        buf.extend(chunk)
+    return buf
+
+def _remove_file(path: str) -> None:
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+
+def _iter_file(arquivo: BinaryIO) -> Iterator[bytes]:
+    """
+    Lê o arquivo em blocos para o StreamingResponse e o fecha no fim (ou se o envio
+    for interrompido).
+    """
+    try:
+        while chunk := arquivo.read(DOWNLOAD_CHUNK_SIZE):
+            yield chunk
+    finally:
+        arquivo.close()
+
+def _processing_error(e: Exception, pool: ProcessPoolExecutor) -> HTTPException:
+    """
+    Converte um erro do processamento no pool na resposta HTTP correspondente.
+    """
+    if isinstance(e, ValueError):
+        return HTTPException(status_code=400, detail=str(e))
+    if isinstance(e, BrokenProcessPool):
+        # Um worker morreu (OOM, segfault do qpdf...): trocar o pool e pedir nova tentativa
+        _replace_broken_pool(pool)
+        return HTTPException(status_code=503, detail=POOL_RESTARTED_DETAIL)
+    # Captura o erro e o detalha para o usuário
+    return HTTPException(status_code=500, detail=f"Erro interno ao processar o PDF: {e}")
+
+# Caracteres fora deste conjunto viram "_" no nome de arquivo do cabeçalho
+_UNSAFE_FILENAME_CHARS = re.compile(rb"[^A-Za-z0-9._-]")
+
+def _safe_name(nome: str) -> str:
+    """
+    Versão ASCII segura de um nome de arquivo, para uso em cabeçalhos HTTP.
+    """
+    return _UNSAFE_FILENAME_CHARS.sub(b"_", nome.encode("ascii", "ignore")).decode("ascii")
+
+def _content_disposition(filename: str) -> str:
+    """
+    Monta o Content-Disposition de download; usa filename* (RFC 5987) só quando
+    o nome original tem caracteres não-ASCII.
+    """
+    header = f'attachment; filename="{_safe_name(filename)}"'
+    if not filename.isascii():
+        header += f"; filename*=UTF-8''{quote(filename, safe='')}"
+    return header
+
 @app.post("/process-pdf/")
 async def process_pdf(
     pdf_file: UploadFile = File(..., description="O arquivo PDF original."),
@@ -109,30 +320,100 @@ async def process_pdf(
     
     # 1. Ler o conteúdo do arquivo PDF
     try:
-        pdf_bytes = await pdf_file.read()
+        pdf_bytes = await _read_upload(pdf_file)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Erro ao ler o arquivo PDF: {e}")
 
-    # 2. Processar o PDF
+    # Rejeitar logo arquivos que não são PDF, antes de ocupar um processo do pool
+    # (o cabeçalho %PDF- pode vir depois de lixo no início, como o qpdf tolera)
+    if PDF_HEADER not in pdf_bytes[:PDF_HEADER_SEARCH_LIMIT]:
+        raise HTTPException(status_code=400, detail="O arquivo enviado não é um PDF válido.")
+
+    headers = {
+        "Content-Disposition": _content_disposition(f"modified_{pdf_file.filename or 'documento.pdf'}")
+    }
+    
+    # 2. Processar o PDF (em um processo do pool)
+    loop = asyncio.get_running_loop()
+    pool = app.state.pool
+    
+    # PDFs grandes: o worker grava direto em um arquivo temporário, que é enviado do
+    # disco, sem voltar como bytes pelo pool nem ficar inteiro na memória da resposta
+    if len(pdf_bytes) > LARGE_PDF_THRESHOLD:
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
+            output_path = tmp.name
+        future = None
+        arquivo = None
+        try:
+            try:
+                future = pool.submit(add_text_to_pdf_logic, pdf_bytes, nome, telefone, output_path)
+                await asyncio.wrap_future(future)
+            except Exception as e:
+                raise _processing_error(e, pool)
+            
+            # Abrir e apagar logo o temporário: o espaço em disco é liberado quando o
+            # arquivo for fechado, aconteça o que acontecer com a resposta. Também evita
+            # FileResponse, que atende Range (206/416) e aí não roda o BackgroundTask
+            arquivo = open(output_path, "rb")
+            _remove_file(output_path)
+            headers["Content-Length"] = str(os.fstat(arquivo.fileno()).st_size)
+        except BaseException:
+            # Qualquer saída antes de o arquivo ser aberto e apagado (erro, requisição
+            # cancelada, shutdown) apaga o temporário. Se o worker ainda estiver gravando,
+            # apaga só quando ele terminar, senão o arquivo seria recriado depois.
+            if arquivo is not None:
+                arquivo.close()
+            if future is None:
+                _remove_file(output_path)
+            else:
+                future.add_done_callback(lambda _: _remove_file(output_path))
+            raise
+        
+        # 3. Retornar o arquivo (já apagado do disco; fechado ao fim do envio)
+        return StreamingResponse(
+            _iter_file(arquivo),
+            media_type="application/pdf",
+            headers=headers,
+        )
+    
     try:
-        modified_pdf_bytes = add_text_to_pdf_logic(pdf_bytes, nome, telefone)
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=str(e))
+        modified_pdf_bytes = await loop.run_in_executor(
+            pool, add_text_to_pdf_logic, pdf_bytes, nome, telefone
+        )
     except Exception as e:
-        # Captura o erro e o detalha para o usuário
-        raise HTTPException(status_code=500, detail=f"Erro interno ao processar o PDF: {e}")
+        raise _processing_error(e, pool)
 
-    # 3. Retornar o PDF modificado como um StreamingResponse
-    return StreamingResponse(
-        io.BytesIO(modified_pdf_bytes),
+    # 3. Retornar o PDF modificado (já está todo em memória, sem cópia extra)
+    return Response(
+        content=modified_pdf_bytes,
         media_type="application/pdf",
-        headers={
-            "Content-Disposition": f"attachment; filename=modified_{pdf_file.filename}"
-        }
+        headers=headers,
     )
 
 # --- Endpoint de Saúde ---
 
+# Corpo pré-serializado: as sondas de saúde não passam pelo encoder JSON
+_HEALTH = b'{"status":"ok","message":"PDF Processor API is running"}'
+
+_HEALTH_POOL_BROKEN = b'{"status":"error","message":"PDF process pool is broken"}'
+HEALTH_PING_TIMEOUT = 1.0 # segundos
+
+def _pool_ping() -> None:
+    """
+    Tarefa vazia, usada pelo /health para verificar se o pool aceita trabalho.
+    """
+
 @app.get("/health")
-def health_check():
-    return {"status": "ok", "message": "PDF Processor API is running"}
+async def health_check():
+    # Pool quebrado (worker morto) recusa novas tarefas com BrokenProcessPool: responder
+    # 503. A troca do pool fica com /process-pdf/. Se o ping não volta a tempo, o pool
+    # só está ocupado com PDFs, o que não é falha.
+    try:
+        await asyncio.wait_for(
+            asyncio.wrap_future(app.state.pool.submit(_pool_ping)), HEALTH_PING_TIMEOUT
+        )
+    except BrokenProcessPool:
+        return Response(content=_HEALTH_POOL_BROKEN, media_type="application/json", status_code=503)
+    except asyncio.TimeoutError:
+        pass
+    return Response(content=_HEALTH, media_type="application/json")
@@ -0,0 +1,44 @@
+import io
+import tempfile
+
+import pikepdf
+import pytest
+from fastapi.testclient import TestClient
+from reportlab.pdfgen import canvas
+
+import app as app_module
+
+
+def _make_pdf(pages: int = 2) -> bytes:
+    packet = io.BytesIO()
+    can = canvas.Canvas(packet)
+    for i in range(pages):
+        can.drawString(100, 400, f"Pagina {i + 1}")
+        can.showPage()
+    can.save()
+    return packet.getvalue()
+
+
+@pytest.fixture
+def large_pdf_client(monkeypatch, tmp_path):
+    # Qualquer upload passa pelo caminho de PDF grande, com temporários em tmp_path
+    monkeypatch.setattr(app_module, "LARGE_PDF_THRESHOLD", 100)
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    with TestClient(app_module.app) as client:
+        yield client
+
+
+@pytest.mark.parametrize("range_header", ["garbage", "bytes=99999999-", "bytes=0-10"])
+def test_large_pdf_ignores_range_and_leaves_no_temp_file(large_pdf_client, tmp_path, range_header):
+    response = large_pdf_client.post(
+        "/process-pdf/",
+        files={"pdf_file": ("exame.pdf", _make_pdf(), "application/pdf")},
+        data={"nome": "Ana", "telefone": "123"},
+        headers={"Range": range_header},
+    )
+
+    assert response.status_code == 200
+    assert response.headers["content-length"] == str(len(response.content))
+    with pikepdf.open(io.BytesIO(response.content)) as pdf:
+        assert len(pdf.pages) == 2
+    assert list(tmp_path.glob("*.pdf")) == []